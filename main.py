@@ -1,13 +1,20 @@
 import os
+import stat
 import click
-import trimesh
-import pye57
-import numpy as np
+import collections
+import contextlib
+import json
+import re
+import threading
 import time
 import datetime
-from tqdm import tqdm
+# Heavy dependencies (numpy, trimesh, pye57, tqdm) are imported by the functions that use them,
+# so that the CLI starts fast and --help does not load them.
+
 # Function to calculate the division points based on the center, box size, and grid size.
 def calculate_grid_division_points(center, box_size, grid_sizes, heights=None):
+    import numpy as np
+
     division_points = []
     
     for axis, (size, grid_size) in enumerate(zip(box_size, grid_sizes)):
@@ -27,103 +34,527 @@ def calculate_grid_division_points(center, box_size, grid_sizes, heights=None):
     
     return division_points
 
+# Columnar container for per-point E57 attributes: one 1D array per field, all of the same length.
+class PointCloudColumns:
+    def __init__(self, columns, parent=None, index=None):
+        import numpy as np
+
+        self.columns = dict(columns)
+        # Position of each point in the scan as loaded, kept apart from the columns so it is never written out.
+        self.index = np.arange(len(self), dtype=np.int64) if index is None else index
+        # Slices share the state of the point cloud they are views of.
+        self._root = parent._root if parent is not None else self
+        self.consistent = True
+
+    def __len__(self):
+        return len(next(iter(self.columns.values()))) if self.columns else 0
+
+    def permute(self, order):
+        # Reorder every column with the same permutation, one column at a time to keep peak memory low.
+        # If this is interrupted, the columns are out of step and the whole point cloud is marked as such.
+        self._root.consistent = False
+        for column in (*self.columns.values(), self.index):
+            column[:] = column[order]
+        self._root.consistent = True
+
+    def slice(self, start, stop):
+        # Views into the columns, no copy is made.
+        return PointCloudColumns({name: column[start:stop] for name, column in self.columns.items()}, parent=self,
+                                 index=self.index[start:stop])
+
+CARTESIAN_FIELDS = ('cartesianX', 'cartesianY', 'cartesianZ')
+SPHERICAL_FIELDS = ('sphericalRange', 'sphericalAzimuth', 'sphericalElevation')
+# Fields pye57's E57.write_scan_raw writes besides the cartesian coordinates. The fields of a group are only
+# written together, any other field is dropped by the writer.
+WRITTEN_FIELD_GROUPS = (('intensity',), ('colorRed', 'colorGreen', 'colorBlue'), ('rowIndex', 'columnIndex'), ('cartesianInvalidState',))
+
+# Function to read the selected fields of the first scan of an E57 file into a columnar container.
+def load_point_cloud(e57_path, fields=None):
+    import numpy as np
+    import pye57
+
+    with pye57.E57(e57_path) as e57_file:
+        header = e57_file.get_header(0)
+        available = header.point_fields
+
+        # Like pye57.E57.read_scan, use the cartesian coordinates if the scan has them, else the spherical ones.
+        if all(field in available for field in CARTESIAN_FIELDS):
+            coordinate_fields, invalid_state = CARTESIAN_FIELDS, 'cartesianInvalidState'
+        elif all(field in available for field in SPHERICAL_FIELDS):
+            coordinate_fields, invalid_state = SPHERICAL_FIELDS, 'sphericalInvalidState'
+        else:
+            raise ValueError(f"E57 file has neither cartesian nor spherical coordinates: {e57_path}")
+
+        # Keep every field of the scan unless a selection is given; the cartesian coordinates are always kept.
+        selected = list(available) if fields is None else list(dict.fromkeys(fields))
+        for field in CARTESIAN_FIELDS:
+            if field not in selected:
+                selected.append(field)
+        skipped = {}
+        for field in selected:
+            if field in CARTESIAN_FIELDS:
+                continue
+            group = next((group for group in WRITTEN_FIELD_GROUPS if field in group), None)
+            if field not in available:
+                skipped[field] = "not available in E57 file"
+            elif group is None:
+                skipped[field] = "not written by the E57 writer"
+            elif any(member not in selected or member not in available for member in group):
+                skipped[field] = f"written by the E57 writer only together with {', '.join(group)}"
+        for field, reason in skipped.items():
+            print(f"Skipping field {reason}: {field}")
+            selected.remove(field)
+
+        # Also read the coordinates and the invalid state, even if they are not kept in the output.
+        to_read = [field for field in selected if field not in CARTESIAN_FIELDS or coordinate_fields is CARTESIAN_FIELDS]
+        to_read += [field for field in coordinate_fields + (invalid_state,) if field in available and field not in to_read]
+        columns = {}
+        buffers = pye57.libe57.VectorSourceDestBuffer()
+        for field in to_read:
+            columns[field], buffer = e57_file.make_buffer(field, header.point_count)
+            buffers.append(buffer)
+        reader = header.points.reader(buffers)
+        reader.read()
+        reader.close()
+
+        # The pose must be read while the file is open, pye57 falls back to the identity pose otherwise.
+        rotation_matrix = header.rotation_matrix
+        translation = header.translation
+
+    # Filter out invalid points.
+    if invalid_state in columns:
+        valid = columns[invalid_state] == 0
+        columns = {field: column[valid] for field, column in columns.items()}
+
+    # Convert the coordinates to cartesian if needed, then apply the scan pose, as pye57.E57.read_scan does.
+    if coordinate_fields is CARTESIAN_FIELDS:
+        xyz = np.column_stack([columns[field] for field in CARTESIAN_FIELDS])
+    else:
+        range_, azimuth, elevation = (columns[field] for field in SPHERICAL_FIELDS)
+        xyz = np.column_stack((range_ * np.cos(elevation) * np.cos(azimuth),
+                               range_ * np.cos(elevation) * np.sin(azimuth),
+                               range_ * np.sin(elevation)))
+    xyz = xyz @ rotation_matrix.T + translation
+    for d, field in enumerate(CARTESIAN_FIELDS):
+        columns[field] = np.ascontiguousarray(xyz[:, d])
+
+    return PointCloudColumns({field: columns[field] for field in selected})
+
+# Function to sort the point cloud by grid cell and return the offsets of each cell.
+def bin_points_to_grid(point_cloud, division_points):
+    import numpy as np
+
+    edges = [np.asarray(points, dtype=np.float64) for points in division_points]
+    cell_counts = [len(axis_edges) - 1 for axis_edges in edges]
+    total_cells = cell_counts[0] * cell_counts[1] * cell_counts[2]
+
+    cell_ids = np.zeros(len(point_cloud), dtype=np.int64)
+    inside = np.ones(len(point_cloud), dtype=bool)
+    for axis, field in enumerate(CARTESIAN_FIELDS):
+        coordinates = point_cloud.columns[field]
+        axis_index = np.searchsorted(edges[axis], coordinates, side='right') - 1
+        # Points lying exactly on the far edge of the grid belong to the last cell.
+        axis_index[coordinates == edges[axis][-1]] = cell_counts[axis] - 1
+        inside &= (axis_index >= 0) & (axis_index < cell_counts[axis])
+        cell_ids = cell_ids * cell_counts[axis] + axis_index
+    # Points outside the grid are sent past the last cell.
+    cell_ids[~inside] = total_cells
+
+    # Within a cell the points keep their order in the scan, whatever order earlier requests left them in.
+    order = np.lexsort((point_cloud.index, cell_ids))
+    point_cloud.permute(order)
+    offsets = np.searchsorted(cell_ids[order], np.arange(total_cells + 1))
+    return offsets
+
+# Function to find the nearest fragment face of each point and its distance to it, in batches to bound memory.
+def associate_points_to_fragment(fragment, points, batch_size):
+    import numpy as np
+    import trimesh
+
+    face_ids = np.full(len(points), -1, dtype=np.int64)
+    distances = np.full(len(points), np.nan)
+    if fragment is None or len(fragment.faces) == 0:
+        return face_ids, distances
+
+    # The first query builds the fragment BVH (trimesh's triangles_tree), later batches reuse it.
+    for start in range(0, len(points), batch_size):
+        stop = min(start + batch_size, len(points))
+        _, distances[start:stop], face_ids[start:stop] = trimesh.proximity.closest_point(fragment, points[start:stop])
+    return face_ids, distances
+
+DEVIATION_BINS = 20  # Default number of bins of the deviation histogram.
+DEVIATION_MAX = 0.1  # Default upper bound of the deviation histogram.
+
+# Function to write the per-point association columns and the deviation histogram of one section.
+def write_section_association(fragment, section, batch_size, deviation_edges, output_folder, i, j, k):
+    import numpy as np
+
+    points = np.column_stack((section.columns['cartesianX'], section.columns['cartesianY'], section.columns['cartesianZ']))
+    face_ids, distances = associate_points_to_fragment(fragment, points, batch_size)
+
+    # Rows follow the point order of the matching point_cloud_section file.
+    association_path = os.path.join(output_folder, f'point_cloud_association_{i}_{j}_{k}.npz')
+    np.savez(association_path, faceId=face_ids, distance=distances)
+
+    # The last bin gathers every deviation above the histogram range.
+    measured = distances[~np.isnan(distances)]
+    counts, _ = np.histogram(measured, bins=deviation_edges)
+    overflow = np.count_nonzero(measured > deviation_edges[-1])
+    histogram_path = os.path.join(output_folder, f'deviation_histogram_{i}_{j}_{k}.csv')
+    with open(histogram_path, 'w') as histogram_file:
+        histogram_file.write('bin_start,bin_end,count\n')
+        for bin_start, bin_end, count in zip(deviation_edges[:-1], deviation_edges[1:], counts):
+            histogram_file.write(f'{bin_start},{bin_end},{count}\n')
+        histogram_file.write(f'{deviation_edges[-1]},inf,{overflow}\n')
+        histogram_file.write(f'unmatched,,{len(distances) - len(measured)}\n')
+
+# Rough working-set sizes, in bytes, used to estimate the memory footprint of a box.
+FACE_BYTES = 1024  # Clipped sub-mesh, boolean result, exported copy and BVH, per face.
+ASSOCIATION_POINT_BYTES = 40  # Stacked coordinates, face id and distance, per point.
+ASSOCIATION_QUERY_BYTES = 2048  # Candidate triangles of trimesh.proximity.closest_point, per queried point.
+MAX_SPLIT_DEPTH = 12  # Boxes are not split in more than 2**12 sub-tiles.
+
+# Click parameter type for a memory size such as "512M", "8G" or "8GiB", converted to bytes.
+class MemorySize(click.ParamType):
+    name = 'size'
+    units = {'': 1, 'K': 1024, 'M': 1024 ** 2, 'G': 1024 ** 3, 'T': 1024 ** 4}
+
+    def convert(self, value, param, ctx):
+        if isinstance(value, int):
+            return value
+        match = re.fullmatch(r'\s*(\d+(?:\.\d+)?)\s*([KMGT]?)(?:i?B)?\s*', value, re.IGNORECASE)
+        if match is None:
+            self.fail(f"{value!r} is not a memory size such as 512M or 8G.", param, ctx)
+        return int(float(match.group(1)) * self.units[match.group(2).upper()])
+
+# Function to estimate the peak memory used to process a box from its point and face counts.
+def estimate_box_memory(point_count, face_count, point_bytes, associate_faces, batch_size):
+    estimate = point_count * point_bytes + face_count * FACE_BYTES
+    if associate_faces:
+        estimate += point_count * ASSOCIATION_POINT_BYTES + min(point_count, batch_size) * ASSOCIATION_QUERY_BYTES
+    return estimate
+
+# Memory budget shared by the boxes in progress: a box waits until its estimate fits in what is left.
+class MemoryBudget:
+    def __init__(self, limit):
+        self.limit = limit
+        self.in_use = 0
+        self._condition = threading.Condition()
+
+    def acquire(self, amount):
+        with self._condition:
+            # A box is always allowed to run alone, even above the limit, so that processing goes on.
+            self._condition.wait_for(lambda: self.in_use == 0 or self.in_use + amount <= self.limit)
+            self.in_use += amount
+
+    def release(self, amount):
+        with self._condition:
+            self.in_use -= amount
+            self._condition.notify_all()
+
+# Function to compute the bounding box of every mesh face, without caching the triangles on the mesh.
+def calculate_face_bounds(mesh):
+    triangles = mesh.vertices[mesh.faces]
+    return triangles.min(axis=1), triangles.max(axis=1)
+
+# Function to list the faces whose bounding box overlaps a box.
+def faces_in_box(face_bounds, min_corner, max_corner, face_ids=None):
+    import numpy as np
+
+    face_min, face_max = face_bounds
+    if face_ids is None:
+        overlap = np.all(face_max >= min_corner, axis=1) & np.all(face_min <= max_corner, axis=1)
+        return np.flatnonzero(overlap)
+    overlap = np.all(face_max[face_ids] >= min_corner, axis=1) & np.all(face_min[face_ids] <= max_corner, axis=1)
+    return face_ids[overlap]
+
+# Function to split a box in halves along its longest axis until the faces of each sub-tile fit in max_faces.
+# Splitting stops when it no longer helps, i.e. when both halves still overlap every face.
+def split_box(min_corner, max_corner, face_ids, face_bounds, max_faces, depth=0):
+    import numpy as np
+
+    if len(face_ids) <= max_faces or depth >= MAX_SPLIT_DEPTH:
+        return [(min_corner, max_corner, face_ids)]
+
+    axis = int(np.argmax(np.subtract(max_corner, min_corner)))
+    middle = (min_corner[axis] + max_corner[axis]) / 2
+    lower_max = list(max_corner)
+    lower_max[axis] = middle
+    upper_min = list(min_corner)
+    upper_min[axis] = middle
+    lower_faces = faces_in_box(face_bounds, min_corner, lower_max, face_ids)
+    upper_faces = faces_in_box(face_bounds, upper_min, max_corner, face_ids)
+    if min(len(lower_faces), len(upper_faces)) == len(face_ids):
+        return [(min_corner, max_corner, face_ids)]
+
+    return (split_box(min_corner, lower_max, lower_faces, face_bounds, max_faces, depth + 1) +
+            split_box(upper_min, max_corner, upper_faces, face_bounds, max_faces, depth + 1))
+
+# Function to find the faces of a mesh lying on one of the given axis-aligned planes, given as (axis, value) pairs.
+def faces_on_planes(mesh, planes, tolerance):
+    import numpy as np
+
+    triangles = mesh.vertices[mesh.faces]
+    on_plane = np.zeros(len(mesh.faces), dtype=bool)
+    for axis, value in planes:
+        on_plane |= np.all(np.abs(triangles[:, :, axis] - value) <= tolerance, axis=1)
+    return on_plane
+
+# Function to replace the faces the boolean leaves on the split planes of a sub-tile, i.e. the sub-tile walls inside
+# the box, by the input faces lying on them. On these walls the boolean adds caps to the open sub-mesh, and input
+# faces lying on a wall may be kept by both sub-tiles or by neither. Instead, the input faces on a split plane are
+# kept by the sub-tile above the plane only, clipped to it, as the boolean of the whole box would keep them.
+def replace_split_plane_faces(fragment, tile_mesh, tile_min, tile_max, box_min, box_max):
+    import numpy as np
+    import trimesh
+
+    tolerance = 1e-6 * max(box_max[d] - box_min[d] for d in range(3))
+    lower_planes = [(axis, tile_min[axis]) for axis in range(3) if tile_min[axis] > box_min[axis]]
+    upper_planes = [(axis, tile_max[axis]) for axis in range(3) if tile_max[axis] < box_max[axis]]
+
+    pieces = []
+    if fragment is not None:
+        kept = ~faces_on_planes(fragment, lower_planes + upper_planes, tolerance)
+        if kept.any():
+            pieces.append(fragment.submesh([np.flatnonzero(kept)], append=True))
+    for axis, value in lower_planes:
+        on_plane = faces_on_planes(tile_mesh, [(axis, value)], tolerance)
+        if not on_plane.any():
+            continue
+        # The faces lie in the plane, so clipping them to the other sub-tile walls adds no caps.
+        piece = tile_mesh.submesh([np.flatnonzero(on_plane)], append=True)
+        for other_axis in range(3):
+            if other_axis == axis:
+                continue
+            normal = np.eye(3)[other_axis]
+            for plane_normal, plane_origin in ((normal, tile_min), (-normal, tile_max)):
+                if piece is not None and len(piece.faces) > 0:
+                    piece = trimesh.intersections.slice_mesh_plane(piece, plane_normal, plane_origin, cap=False)
+        if piece is not None and len(piece.faces) > 0:
+            pieces.append(piece)
+
+    if not pieces:
+        return None
+    return pieces[0] if len(pieces) == 1 else trimesh.util.concatenate(pieces)
+
+# Function to intersect a mesh with a box, returning the fragment inside the box or None.
+def intersect_mesh_with_box(mesh, min_corner, max_corner):
+    import trimesh
+
+    # Calculate the center and extents for the current box.
+    center = [(min_corner[d] + max_corner[d]) / 2 for d in range(3)]
+    extents = [max_corner[d] - min_corner[d] for d in range(3)]
+
+    # Create a box mesh for the current section.
+    box = trimesh.creation.box(extents=extents, transform=trimesh.transformations.translation_matrix(center))
+
+    # Attempt to intersect the mesh with the box.
+    try:
+        result = trimesh.boolean.intersection([mesh, box], engine='blender',check_volume=False,use_exact=True)
+        if isinstance(result, (trimesh.Scene, trimesh.Trimesh)) and not result.is_empty:
+            if isinstance(result, trimesh.Scene):
+                # Scene.dump(concatenate=True) is deprecated since trimesh 4, which added Scene.to_mesh.
+                return result.to_mesh() if hasattr(result, 'to_mesh') else result.dump(concatenate=True)
+            return result
+    except Exception as e:
+        print(f"Error intersecting mesh and box: {e}")
+    return None
+
 # Function to segment the mesh and point cloud based on grid division points.
-def segment_based_on_grid(mesh, point_cloud_data, point_cloud_colors, division_points, output_folder):
+def segment_based_on_grid(mesh, point_cloud, division_points, output_folder, associate_faces=False, batch_size=100000, deviation_edges=None,
+                          workers=None, memory_limit=None):
+    import numpy as np
+    import trimesh
+    import pye57
+    from tqdm import tqdm
+    from concurrent.futures import ThreadPoolExecutor
+
+    if associate_faces and deviation_edges is None:
+        deviation_edges = np.linspace(0, DEVIATION_MAX, DEVIATION_BINS + 1)
+
     total_boxes = 0  # Initialize to count relevant boxes
     start_time = time.time()
 
     # Calculate object bounds
     object_min, object_max = mesh.bounds
 
-    with tqdm(desc="Processing boxes") as pbar:  # Dynamic total will be updated
-        for i in range(len(division_points[0]) - 1):
-            for j in range(len(division_points[1]) - 1):
-                for k in range(len(division_points[2]) - 1):
-                    # Determine the corners of the current box.
-                    min_corner = [division_points[0][i], division_points[1][j], division_points[2][k]]
-                    max_corner = [division_points[0][i+1], division_points[1][j+1], division_points[2][k+1]]
-
-                    # Check if the box intersects the object's bounding box
-                    if not (
-                        any(object_max < min_corner) or any(object_min > max_corner)
-                    ):
-                        total_boxes += 1  # Increment count for relevant boxes
-
-                        # Calculate the center and extents for the current box.
-                        center = [(min_corner[d] + max_corner[d]) / 2 for d in range(3)]
-                        extents = [max_corner[d] - min_corner[d] for d in range(3)]
-
-                        # Create a box mesh for the current section.
-                        box = trimesh.creation.box(extents=extents, transform=trimesh.transformations.translation_matrix(center))
-                        #box_path = os.path.join(output_folder, f'box_{i}_{j}_{k}.obj')
-                        #box.export(box_path)
-
-                        # Attempt to intersect the mesh with the box, exporting the result.
-                        try:
-                            result = trimesh.boolean.intersection([mesh, box], engine='blender',check_volume=False,use_exact=True)
-                            if isinstance(result, (trimesh.Scene, trimesh.Trimesh)) and not result.is_empty:
-                                result.unmerge_vertices()
+    # Sort the points by cell once, so every box reads its points as a contiguous slice.
+    cell_offsets = bin_points_to_grid(point_cloud, division_points)
+
+    # Under a memory limit, estimate each box from its point and face counts, and keep what the loaded inputs
+    # do not use as the budget of the boxes in progress. Only the faces decide whether a box is split, as
+    # the points of a box are a view of the loaded point cloud and splitting them would not reduce memory.
+    budget = None
+    if memory_limit is not None:
+        face_bounds = calculate_face_bounds(mesh)
+        point_bytes = sum(column.itemsize for column in point_cloud.columns.values())
+        estimate = lambda point_count, face_count: estimate_box_memory(point_count, face_count, point_bytes, associate_faces, batch_size)
+        resident = (sum(column.nbytes for column in point_cloud.columns.values()) + mesh.vertices.nbytes + mesh.faces.nbytes +
+                    face_bounds[0].nbytes + face_bounds[1].nbytes)
+        budget = MemoryBudget(memory_limit - resident)
+        # Faces a sub-tile may have once the points of its box are accounted for; with no budget left for them,
+        # splitting cannot help and the whole box is processed alone.
+        max_tile_faces = lambda point_count: max((budget.limit - estimate(point_count, 0)) // FACE_BYTES, 0)
+        if budget.limit <= 0:
+            print(f"Loaded inputs use {resident} bytes, above the memory limit: processing one box at a time.")
+        else:
+            # Pre-pass counting the points and faces of the boxes the main loop processes, to report those that will be split.
+            oversized_boxes = 0
+            for i in range(len(division_points[0]) - 1):
+                for j in range(len(division_points[1]) - 1):
+                    for k in range(len(division_points[2]) - 1):
+                        min_corner = [division_points[0][i], division_points[1][j], division_points[2][k]]
+                        max_corner = [division_points[0][i+1], division_points[1][j+1], division_points[2][k+1]]
+                        if not (any(object_max < min_corner) or any(object_min > max_corner)):
+                            cell = (i * (len(division_points[1]) - 1) + j) * (len(division_points[2]) - 1) + k
+                            max_faces = max_tile_faces(cell_offsets[cell + 1] - cell_offsets[cell])
+                            if max_faces > 0 and len(faces_in_box(face_bounds, min_corner, max_corner)) > max_faces:
+                                oversized_boxes += 1
+            print(f"Memory budget: {budget.limit} bytes, {oversized_boxes} boxes will be split into sub-tiles.")
+
+    # Point-to-face association runs in parallel across tiles while the next boxes are intersected.
+    # The executor is shut down even if a box fails, so that a daemon does not leak its threads.
+    with ThreadPoolExecutor(max_workers=workers) if associate_faces else contextlib.nullcontext() as executor:
+        association_jobs = []
+
+        with tqdm(desc="Processing boxes") as pbar:  # Dynamic total will be updated
+            for i in range(len(division_points[0]) - 1):
+                for j in range(len(division_points[1]) - 1):
+                    for k in range(len(division_points[2]) - 1):
+                        # Determine the corners of the current box.
+                        min_corner = [division_points[0][i], division_points[1][j], division_points[2][k]]
+                        max_corner = [division_points[0][i+1], division_points[1][j+1], division_points[2][k+1]]
+
+                        # Check if the box intersects the object's bounding box
+                        if not (
+                            any(object_max < min_corner) or any(object_min > max_corner)
+                        ):
+                            total_boxes += 1  # Increment count for relevant boxes
+
+                            # Segment the point cloud based on the current box.
+                            cell = (i * (len(division_points[1]) - 1) + j) * (len(division_points[2]) - 1) + k
+                            section = point_cloud.slice(cell_offsets[cell], cell_offsets[cell + 1])
+
+                            tiles = None
+                            if budget is not None:
+                                face_ids = faces_in_box(face_bounds, min_corner, max_corner)
+                                max_faces = max_tile_faces(len(section))
+                                if max_faces > 0:
+                                    tiles = split_box(min_corner, max_corner, face_ids, face_bounds, max_faces)
+                                # Boxes larger than the whole budget reserve all of it, so that they run alone.
+                                reserved = estimate(len(section), len(face_ids))
+                                if budget.limit > 0:
+                                    reserved = min(reserved, budget.limit)
+                                budget.acquire(reserved)
+
+                            # Split boxes are intersected one sub-tile at a time, with the faces the sub-tile overlaps only,
+                            # keeping the input faces on their split planes once. Other boxes are intersected with the whole mesh.
+                            if tiles is not None and len(tiles) > 1:
+                                tile_fragments = []
+                                for tile_min, tile_max, tile_faces in tiles:
+                                    tile_fragment = None
+                                    if len(tile_faces) > 0:
+                                        tile_mesh = mesh.submesh([tile_faces], append=True)
+                                        tile_fragment = intersect_mesh_with_box(tile_mesh, tile_min, tile_max)
+                                        tile_fragment = replace_split_plane_faces(tile_fragment, tile_mesh, tile_min, tile_max, min_corner, max_corner)
+                                        del tile_mesh
+                                    tile_fragments.append(tile_fragment)
+                            else:
+                                tile_fragments = [intersect_mesh_with_box(mesh, min_corner, max_corner)]
+
+                            # Merge the sub-tile fragments back into the fragment of the box, exporting the result.
+                            fragments = [fragment for fragment in tile_fragments if fragment is not None]
+                            del tile_fragments
+                            fragment = None
+                            if fragments:
+                                fragment = fragments[0] if len(fragments) == 1 else trimesh.util.concatenate(fragments)
+                                fragment.unmerge_vertices()
                                 fragment_path = os.path.join(output_folder, f'mesh_fragment_{i}_{j}_{k}.obj')
-                                result.export(fragment_path)
-                        except Exception as e:
-                            print(f"Error intersecting mesh and box: {e}")
-                            
-
-                        # Segment the point cloud based on the current box.
-                        in_box = np.all((point_cloud_data >= min_corner) & (point_cloud_data <= max_corner), axis=1)
-                        section_points = point_cloud_data[in_box]
-                        if point_cloud_colors is not None:
-                            section_colors = point_cloud_colors[in_box]
-                        else:
-                            # Handle the case where there are no color data
-                            section_colors = None  # Or an appropriate default value
-
-                        if section_points.size > 0:
-                            section_output_file = os.path.join(output_folder, f'point_cloud_section_{i}_{j}_{k}.e57')
-                            with pye57.E57(section_output_file, mode='w') as section_e57_file:
-                                scan_fields = {
-                                    'cartesianX': section_points[:, 0],
-                                    'cartesianY': section_points[:, 1],
-                                    'cartesianZ': section_points[:, 2]
-                                }
-                                # Include color data if available
-                                if section_colors is not None:
-                                    scan_fields.update({
-                                        'colorRed': section_colors[:, 0],
-                                        'colorGreen': section_colors[:, 1],
-                                        'colorBlue': section_colors[:, 2],
-                                    })
-                                section_e57_file.write_scan_raw(scan_fields)
-
-                        # Update progress bar and display information
-                        pbar.update(1)
-
-                        elapsed_time = time.time() - start_time
-                        processed_boxes = i * (len(division_points[1]) - 1) * (len(division_points[2]) - 1) + j * (len(division_points[2]) - 1) + k + 1
-
-                        percentage = (processed_boxes / total_boxes) * 100
-
-                        time_per_box = elapsed_time / processed_boxes
-                        remaining_boxes = total_boxes - processed_boxes
-                        remaining_time = time_per_box * remaining_boxes
-                        remaining_time_str = str(datetime.timedelta(seconds=round(remaining_time)))
-
-                        pbar.set_postfix_str(f"Remaining: {remaining_boxes}, %{percentage:.2f}, Time: {remaining_time_str}")
+                                fragment.export(fragment_path)
+                            del fragments
+
+                            # The points are not split, so the section is written at once.
+                            job = None
+                            if len(section) > 0:
+                                section_output_file = os.path.join(output_folder, f'point_cloud_section_{i}_{j}_{k}.e57')
+                                with pye57.E57(section_output_file, mode='w') as section_e57_file:
+                                    section_e57_file.write_scan_raw(section.columns)
+                                if associate_faces:
+                                    job = executor.submit(write_section_association, fragment, section, batch_size, deviation_edges, output_folder, i, j, k)
+                                    association_jobs.append(job)
+
+                            # Give the reserved memory back once the box is done, including its association.
+                            if budget is not None:
+                                if job is not None:
+                                    job.add_done_callback(lambda _, reserved=reserved: budget.release(reserved))
+                                else:
+                                    budget.release(reserved)
+
+                            # Update progress bar and display information
+                            pbar.update(1)
+
+                            elapsed_time = time.time() - start_time
+                            processed_boxes = i * (len(division_points[1]) - 1) * (len(division_points[2]) - 1) + j * (len(division_points[2]) - 1) + k + 1
+
+                            percentage = (processed_boxes / total_boxes) * 100
+
+                            time_per_box = elapsed_time / processed_boxes
+                            remaining_boxes = total_boxes - processed_boxes
+                            remaining_time = time_per_box * remaining_boxes
+                            remaining_time_str = str(datetime.timedelta(seconds=round(remaining_time)))
+
+                            pbar.set_postfix_str(f"Remaining: {remaining_boxes}, %{percentage:.2f}, Time: {remaining_time_str}")
     
-    pbar.reset(total=total_boxes)  # Set final total for the progress bar
-    pbar.refresh()  # Update progress bar display 
+        pbar.reset(total=total_boxes)  # Set final total for the progress bar
+        pbar.refresh()  # Update progress bar display 
 
+        # Wait for the remaining associations, raising any error they hit.
+        if associate_faces:
+            for job in tqdm(association_jobs, desc="Associating points to faces"):
+                job.result()
+
+
+# Inputs kept in memory by the serve mode, keyed by loader, path, modification time and loading options.
+# The least recently used inputs are dropped once more than max_entries are loaded.
+class InputCache:
+    def __init__(self, max_entries):
+        self.max_entries = max_entries
+        self._entries = collections.OrderedDict()
+
+    def load(self, loader, path, *options):
+        path = os.path.abspath(path)
+        key = (loader.__name__, path, os.stat(path).st_mtime_ns, *options)
+        entry = self._entries.get(key)
+        # A point cloud whose reordering was interrupted by an error must be reloaded.
+        if isinstance(entry, PointCloudColumns) and not entry.consistent:
+            del self._entries[key]
+            entry = None
+        if entry is not None:
+            self._entries.move_to_end(key)
+            return entry
+
+        # Drop the older versions of the same file, then make room before loading.
+        for stale_key in [k for k in self._entries if k[:2] == key[:2] and k[2] != key[2]]:
+            del self._entries[stale_key]
+        while len(self._entries) >= self.max_entries:
+            self._entries.popitem(last=False)
+        entry = self._entries[key] = loader(path, *options)
+        return entry
+
+# Function to load a mesh file.
+def load_mesh(obj_path):
+    import trimesh
+
+    return trimesh.load(obj_path)
+
+# Function to load the inputs and run the segmentation, optionally through a cache of inputs already in memory.
+def run_segmentation(obj_file, e57_file, output_directory, grid_size, box_size, heights, center, fields, associate_faces,
+                     association_batch, deviation_bins, deviation_max, workers, memory_limit, cache=None):
+    import numpy as np
+    from tqdm import tqdm
+
+    load = cache.load if cache is not None else (lambda loader, path, *options: loader(path, *options))
 
-# CLI command setup using click to parse arguments.
-@click.command()
-@click.option('--obj_file', type=click.Path(exists=True), help='Path to the OBJ file.')
-@click.option('--e57_file', type=click.Path(exists=True), help='Path to the E57 file.')
-@click.option('--output_directory', type=click.Path(), required=True, help='Directory to save the output sections.')
-@click.option('--grid_size', type=str, default='5x5x5', help='Grid size for sectioning, format: x,y,z')
-@click.option('--box_size', type=str, default='1x1x1', help='Box size for sectioning, format: x,y,z')
-@click.option('--heights', type=str, default='', help='List of heights for each Z layer, separated by commas. Example: "1.5,2"')
-@click.option('--center', type=str, default='0,0,0', help='Center of the grid in format x,y,z. Default is "0,0,0".')
-def main(obj_file, e57_file, output_directory, grid_size, box_size, heights, center):
     # Ensure the output directory exists.
     if not os.path.exists(output_directory):
         os.makedirs(output_directory)
@@ -133,11 +564,12 @@ def main(obj_file, e57_file, output_directory, grid_size, box_size, heights, cen
     box_sizes = tuple(map(float, box_size.split('x')))
     heights_list = [float(h) for h in heights.split(',')] if heights else None
     center_list = [float(c) for c in center.split(',')]
+    fields_list = tuple(f.strip() for f in fields.split(',')) if fields else None
     # Load the mesh with progress tracking
     print("Loading OBJ file...")
     with tqdm(total=1, desc="OBJ Progress") as pbar:
         start_time = time.time()
-        mesh = trimesh.load(obj_file) if obj_file else None
+        mesh = load(load_mesh, obj_file) if obj_file else None
         elapsed_time = time.time() - start_time
         pbar.update(1)
         pbar.set_postfix_str(f"Time taken: {datetime.timedelta(seconds=round(elapsed_time))}")
@@ -146,24 +578,113 @@ def main(obj_file, e57_file, output_directory, grid_size, box_size, heights, cen
     print("Loading E57 file...")
     with tqdm(total=1, desc="E57 Progress") as pbar:
         start_time = time.time()
-        point_cloud_data = None
-        point_cloud_colors = None
-        if e57_file:
-            with pye57.E57(e57_file) as e57_file:
-                data = e57_file.read_scan(0, colors=True, ignore_missing_fields=True)
-                point_cloud_data = np.column_stack((data['cartesianX'], data['cartesianY'], data['cartesianZ']))
-                if 'colorRed' in data and 'colorGreen' in data and 'colorBlue' in data:
-                    point_cloud_colors = np.column_stack((data['colorRed'], data['colorGreen'], data['colorBlue']))
+        point_cloud = load(load_point_cloud, e57_file, fields_list) if e57_file else None
         elapsed_time = time.time() - start_time
         pbar.update(1)
         pbar.set_postfix_str(f"Time taken: {datetime.timedelta(seconds=round(elapsed_time))}")
 
     # Proceed with segmentation if mesh and point cloud data are available.
-    if mesh and point_cloud_data is not None:
+    if mesh and point_cloud is not None:
         object_size = mesh.bounds[1] - mesh.bounds[0]
         print(f"Object OBJ size: X: {object_size[0]}, Y: {object_size[1]}, Z: {object_size[2]}")
         
         division_points = calculate_grid_division_points(center_list, box_sizes, grid_sizes, heights=heights_list)
-        segment_based_on_grid(mesh, point_cloud_data, point_cloud_colors, division_points, output_directory)
+        deviation_edges = np.linspace(0, deviation_max, deviation_bins + 1)
+        segment_based_on_grid(mesh, point_cloud, division_points, output_directory, associate_faces=associate_faces,
+                              batch_size=association_batch, deviation_edges=deviation_edges, workers=workers,
+                              memory_limit=memory_limit)
+
+# Function to run the daemon: segmentation requests are read from a Unix socket, one JSON object per line,
+# and run with the meshes and point clouds kept in memory between requests.
+def serve(socket_path, cache_size):
+    import socket
+    import socketserver
+
+    cache = InputCache(cache_size)
+
+    class SegmentationRequestHandler(socketserver.StreamRequestHandler):
+        def handle(self):
+            line = self.rfile.readline()
+            # Connections closed without a request, such as the probe of a second daemon, are ignored.
+            if not line.strip():
+                return
+            try:
+                options = json.loads(line)
+                run_segmentation(**options, cache=cache)
+                response = {'status': 'ok'}
+            except Exception as e:
+                print(f"Error running segmentation request: {e}")
+                response = {'status': 'error', 'message': str(e)}
+            try:
+                self.wfile.write((json.dumps(response) + '\n').encode())
+            except (BrokenPipeError, ConnectionResetError):
+                print("Client disconnected before the response was sent.")
+
+    # Only remove the socket left behind by a daemon that is no longer running.
+    if os.path.lexists(socket_path):
+        if not stat.S_ISSOCK(os.lstat(socket_path).st_mode):
+            raise click.ClickException(f"{socket_path} exists and is not a socket.")
+        with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as probe:
+            try:
+                probe.connect(socket_path)
+            except ConnectionRefusedError:
+                os.remove(socket_path)
+            else:
+                raise click.ClickException(f"A daemon is already serving on {socket_path}.")
+    print(f"Serving segmentation requests on {socket_path}")
+    # Requests are handled one at a time, as they share the cached inputs.
+    with socketserver.UnixStreamServer(socket_path, SegmentationRequestHandler) as server:
+        try:
+            server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            os.remove(socket_path)
+
+# Function to send a segmentation request to the daemon and wait for its answer.
+def send_to_daemon(socket_path, options):
+    import socket
+
+    # The daemon may run from another directory.
+    for name in ('obj_file', 'e57_file', 'output_directory'):
+        if options[name]:
+            options[name] = os.path.abspath(options[name])
+
+    with socket.socket(socket.AF_UNIX, socket.SOCK_STREAM) as client:
+        client.connect(socket_path)
+        client.sendall((json.dumps(options) + '\n').encode())
+        response = json.loads(client.makefile('rb').readline())
+    if response['status'] != 'ok':
+        raise click.ClickException(response['message'])
+    print(f"Segmentation done by daemon on {socket_path}")
+
+# CLI command setup using click to parse arguments.
+@click.command()
+@click.option('--obj_file', type=click.Path(exists=True), help='Path to the OBJ file.')
+@click.option('--e57_file', type=click.Path(exists=True), help='Path to the E57 file.')
+@click.option('--output_directory', type=click.Path(), help='Directory to save the output sections. Required unless --serve is used.')
+@click.option('--grid_size', type=str, default='5x5x5', help='Grid size for sectioning, format: x,y,z')
+@click.option('--box_size', type=str, default='1x1x1', help='Box size for sectioning, format: x,y,z')
+@click.option('--heights', type=str, default='', help='List of heights for each Z layer, separated by commas. Example: "1.5,2"')
+@click.option('--center', type=str, default='0,0,0', help='Center of the grid in format x,y,z. Default is "0,0,0".')
+@click.option('--fields', type=str, default='', help='E57 fields to keep in the sections, separated by commas. Example: "intensity,colorRed,colorGreen,colorBlue". Default keeps all fields.')
+@click.option('--associate_faces', is_flag=True, help='Find the nearest mesh fragment face of each section point and its distance to it.')
+@click.option('--association_batch', type=click.IntRange(min=1), default=100000, help='Number of points queried at once when associating points to faces.')
+@click.option('--deviation_bins', type=click.IntRange(min=1), default=DEVIATION_BINS, help='Number of bins of the per-section deviation histogram.')
+@click.option('--deviation_max', type=click.FloatRange(min=0, min_open=True), default=DEVIATION_MAX, help='Upper bound of the deviation histogram, larger distances are counted in an overflow bin.')
+@click.option('--workers', type=click.IntRange(min=1), default=None, help='Number of sections associated in parallel. Default is the ThreadPoolExecutor default, min(32, number of CPUs + 4).')
+@click.option('--memory_limit', type=MemorySize(), default=None, help='Memory limit of the segmentation, for example "8G". Boxes above it are split into sub-tiles and fewer sections are processed at once.')
+@click.option('--serve', 'serve_socket', type=click.Path(), help='Run as a daemon answering segmentation requests on this Unix socket, keeping loaded inputs in memory.')
+@click.option('--cache_size', type=click.IntRange(min=1), default=4, help='Number of loaded meshes and point clouds kept in memory by --serve.')
+@click.option('--daemon', 'daemon_socket', type=click.Path(exists=True), help='Send the segmentation request to the daemon listening on this Unix socket instead of running it here.')
+def main(serve_socket, cache_size, daemon_socket, **options):
+    if serve_socket:
+        serve(serve_socket, cache_size)
+    elif not options['output_directory']:
+        raise click.UsageError("Missing option '--output_directory'.")
+    elif daemon_socket:
+        send_to_daemon(daemon_socket, options)
+    else:
+        run_segmentation(**options)
 if __name__ == '__main__':
     main()